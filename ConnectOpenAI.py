@@ -1,10 +1,88 @@
-from typing import Tuple
+import functools
+import os
+import threading
+from typing import Dict, Iterator, List, Tuple
 
 import openai
+import requests
 import tiktoken
 import variables
 import time
 
+# Keeping the files of the encodings next to the app, so they are only downloaded once and not on every cold start
+os.environ.setdefault('TIKTOKEN_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.tiktoken_cache'))
+
+_MODEL_ALIASES = {
+    "gpt-3.5-turbo": "gpt-3.5-turbo-0301",
+    "gpt-4": "gpt-4-0314",
+}
+# The tokens added per message and per name for each model
+_MODEL_TOKENS = {
+    "gpt-3.5-turbo-0301": (4, -1),  # every message follows <|start|>{role/name}\n{content}<|end|>\n, no role with name
+    "gpt-4-0314": (3, 1),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Returns the tiktoken encoding for a model, loading it only once per process.
+
+    :param model: The name of the model to get the encoding for.
+    :return: The encoding for the model, or the cl100k_base encoding if the model is not known by tiktoken.
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        print("Warning: model not found. Using cl100k_base encoding.")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@functools.lru_cache(maxsize=32)
+def _count_tokens(model: str, text: str) -> int:
+    """
+    Returns the number of tokens of a text, remembering it for the texts that are sent often, like the instructions.
+
+    :param model: The name of the model to count the tokens for.
+    :param text: The text to count the tokens of.
+    :return: The number of tokens of the text.
+    """
+    return len(_get_encoding(model).encode(text))
+
+
+# Loading the encodings of the models we use when the module is imported, so the first story doesn't pay for it
+for _model in _MODEL_TOKENS:
+    _get_encoding(_model)
+
+
+class _SharedSession(requests.Session):
+    """
+    A single HTTP session for the whole process, which keeps the connections to the API alive, so every request
+    doesn't pay the TLS handshake.
+
+    openai keeps a session per thread and closes it after a few minutes to renew it. As every thread gets this same
+    session, closing it would drop the connections the other threads are using, so it is never closed.
+    """
+    def close(self) -> None:
+        pass
+
+
+_session = _SharedSession()
+_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=10, max_retries=2))
+openai.requestssession = _session
+
+
+class _RunState(threading.local):
+    """
+    The results of the last request, kept per thread.
+
+    A single ConnectOpenAI instance is shared by all the Streamlit sessions, and each script run happens in its own
+    thread, so the results of a request never leak into another session.
+    """
+    estimated_tokens = 0
+    total_tokens = 0
+    finish_reason = None
+
 
 class ConnectOpenAI:
     def __init__(self, api_key: str, **kwargs):
@@ -14,43 +92,74 @@ class ConnectOpenAI:
         self.frequency_penalty = kwargs.get('frequency_penalty', 0.2)
         self.presence_penalty = kwargs.get('presence_penalty', 0.2)
 
-        self.estimated_tokens = 0
-        self.total_tokens = 0
+        self._state = _RunState()
+
+    @property
+    def estimated_tokens(self) -> int:
+        return self._state.estimated_tokens
+
+    @estimated_tokens.setter
+    def estimated_tokens(self, value: int) -> None:
+        self._state.estimated_tokens = value
+
+    @property
+    def total_tokens(self) -> int:
+        return self._state.total_tokens
+
+    @total_tokens.setter
+    def total_tokens(self, value: int) -> None:
+        self._state.total_tokens = value
+
+    @property
+    def finish_reason(self) -> str:
+        return self._state.finish_reason
+
+    @finish_reason.setter
+    def finish_reason(self, value: str) -> None:
+        self._state.finish_reason = value
 
     def num_tokens_from_messages(self, messages, model="gpt-3.5-turbo-0301"):
         """Returns the number of tokens used by a list of messages."""
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            print("Warning: model not found. Using cl100k_base encoding.")
-            encoding = tiktoken.get_encoding("cl100k_base")
-        if model == "gpt-3.5-turbo":
-            print("Warning: gpt-3.5-turbo may change over time. Returning num tokens assuming gpt-3.5-turbo-0301.")
-            return self.num_tokens_from_messages(messages, model="gpt-3.5-turbo-0301")
-        elif model == "gpt-4":
-            print("Warning: gpt-4 may change over time. Returning num tokens assuming gpt-4-0314.")
-            return self.num_tokens_from_messages(messages, model="gpt-4-0314")
-        elif model == "gpt-3.5-turbo-0301":
-            tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-            tokens_per_name = -1  # if there's a name, the role is omitted
-        elif model == "gpt-4-0314":
-            tokens_per_message = 3
-            tokens_per_name = 1
-        else:
+        # The models that may change over time are counted as their snapshot
+        model = _MODEL_ALIASES.get(model, model)
+        if model not in _MODEL_TOKENS:
             raise NotImplementedError(
                 f"""num_tokens_from_messages() is not implemented for model {model}. 
                 See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are 
                 converted to tokens.""")
-        num_tokens = 0
+        tokens_per_message, tokens_per_name = _MODEL_TOKENS[model]
+        encoding = _get_encoding(model)
+        num_tokens = tokens_per_message * len(messages)
         for message in messages:
-            num_tokens += tokens_per_message
             for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
+                if key == "content" and message.get("role") == "system":
+                    # The instructions are the same for every story, so their tokens are only counted once
+                    num_tokens += _count_tokens(model, value)
+                else:
+                    num_tokens += len(encoding.encode(value))
                 if key == "name":
                     num_tokens += tokens_per_name
         num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
         return num_tokens
 
+    @staticmethod
+    def build_messages(user_message: str, instruction: str) -> List[Dict[str, str]]:
+        """
+        Builds the messages to send to the ChatCompletion API.
+
+        The instruction goes first, in its own system message, and the user's message goes last. The instruction must
+        be sent exactly the same every time, without any data of the request in it, so that OpenAI can reuse the
+        cached prefix of the prompt and bill it at a discount.
+
+        :param user_message: The message provided by the user to be used as the basis for the story.
+        :param instruction: The instruction to guide the AI in generating the story.
+        :return: The list of messages.
+        """
+        return [
+            {"role": "system", "content": instruction},
+            {"role": "user", "content": user_message},
+        ]
+
     def moderate_message(self, user_message: str, test: bool = False, test_flagged: bool = False) -> bool:
         """
         Uses OpenAI's Moderation API to check if the user's message violates any content policies.
@@ -72,8 +181,7 @@ class ConnectOpenAI:
         if test:
             flagged = test_flagged
         else:
-            openai.api_key = self.api_key
-            response = openai.Moderation.create(input=user_message)
+            response = openai.Moderation.create(input=user_message, api_key=self.api_key)
             flagged = response['results'][0]['flagged']
         return flagged
 
@@ -83,6 +191,7 @@ class ConnectOpenAI:
         Generates a story using OpenAI's ChatCompletion API based on a given user message and an instruction.
 
         This function can also be run in a test mode where the story generation is simulated.
+        It collects the whole story from `create_story_stream`, so both share the same request.
 
         :param user_message: The message provided by the user to be used as the basis for the story.
         :param instruction: The instruction to guide the AI in generating the story.
@@ -92,38 +201,69 @@ class ConnectOpenAI:
                      Defaults to False.
         :param test_reason: A string indicating the reason the story generation was completed when in test mode.
                             Defaults to 'stop'.
-        :param wait_time: The number of seconds to wait before returning the story when in test mode.
+        :param wait_time: The number of seconds it takes to return the story when in test mode.
                           Default to 1.
         :return: A tuple containing the generated story and the reason the story generation was completed (either
                  the 'finish_reason' from the API response or the 'test_reason' when in test mode).
         """
+        story = ''.join(self.create_story_stream(user_message, instruction, test=test, test_reason=test_reason,
+                                                 wait_time=wait_time))
+        return story, self.finish_reason
+
+    def create_story_stream(self, user_message: str, instruction: str, test: bool = False, test_reason: str = 'stop',
+                            wait_time: int = 1) -> Iterator[str]:
+        """
+        Generates a story using OpenAI's ChatCompletion API, yielding the story in pieces as soon as they are generated.
+
+        Once the generator is exhausted, the reason the story generation was completed is available in
+        `finish_reason`. As the streaming API doesn't report the usage, `total_tokens` is computed locally.
+
+        :param user_message: The message provided by the user to be used as the basis for the story.
+        :param instruction: The instruction to guide the AI in generating the story.
+        :param test: A boolean flag indicating if the function is being run in a test mode.
+                     If True, the function does not actually call the OpenAI API and instead yields an example story
+                     and sets a test reason.
+                     Defaults to False.
+        :param test_reason: A string indicating the reason the story generation was completed when in test mode.
+                            Defaults to 'stop'.
+        :param wait_time: The number of seconds it takes to yield the whole story when in test mode.
+                          Default to 1.
+        :return: An iterator over the pieces of the generated story.
+        """
+        self.finish_reason = None
         if test:
             if not any(test_reason in reason for reason in ('stop', 'length', 'content_filter')):
                 test_reason = 'stop'
-            time.sleep(wait_time)
-            story = variables.example_story
-            finish_reason = test_reason
+            words = variables.example_story.split(' ')
+            for word in words:
+                time.sleep(wait_time / len(words))
+                yield f'{word} '
+            self.finish_reason = test_reason
         else:
             print('Generating a story for:')
             print(user_message)
-            messages = [
-                {"role": "system", "content": instruction},
-                {"role": "user", "content": user_message},
-            ]
-            self.estimated_tokens = self.num_tokens_from_messages(messages, self.model)
-            openai.api_key = self.api_key
+            messages = self.build_messages(user_message, instruction)
             response = openai.ChatCompletion.create(
+                api_key=self.api_key,
                 model=self.model,
                 messages=messages,
                 max_tokens=self.max_tokens,
                 frequency_penalty=self.frequency_penalty,
                 presence_penalty=self.presence_penalty,
+                stream=True,
             )
 
-            story = response['choices'][0]['message']['content']
+            story = []
+            for chunk in response:
+                content = chunk['choices'][0]['delta'].get('content', '')
+                if content:
+                    story.append(content)
+                    yield content
+                if chunk['choices'][0]['finish_reason'] is not None:
+                    self.finish_reason = chunk['choices'][0]['finish_reason']
             print('Story generated.')
-            finish_reason = response['choices'][0]['finish_reason']
-            self.total_tokens = response['usage']['total_tokens']
+            # Counting the tokens once the story is complete, so it doesn't delay the request
+            self.estimated_tokens = self.num_tokens_from_messages(messages, self.model)
+            encoding = _get_encoding(_MODEL_ALIASES.get(self.model, self.model))
+            self.total_tokens = self.estimated_tokens + len(encoding.encode(''.join(story)))
             print(f'Total used tokens: {self.total_tokens}')
-
-        return story, finish_reason
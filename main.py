@@ -1,143 +1,548 @@
-from typing import List, Dict
+from typing import Iterator, List, Dict, Optional, Tuple
+import atexit
+import concurrent.futures
 import ConnectOpenAI
 import smtplib
+import threading
 from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import datetime
 import streamlit as st
 import gspread
 from google.oauth2.service_account import Credentials
 import variables
 import random
+import re
+import string
+import time
+import uuid
 
 scopes = [
     "https://www.googleapis.com/auth/spreadsheets",
 ]
 
-skey = st.secrets["gcp_service_account"]
-credentials = Credentials.from_service_account_info(
-    skey,
-    scopes=scopes,
-)
-client = gspread.authorize(credentials)
 
+@st.cache_resource
+def get_gspread_client() -> gspread.Client:
+    """
+    Authorizes the client for the Google Sheets API, only once for all the sessions and reruns.
+
+    :return: The authorized client.
+    """
+    credentials = Credentials.from_service_account_info(
+        st.secrets["gcp_service_account"],
+        scopes=scopes,
+    )
+    return gspread.authorize(credentials)
+
+
+@st.cache_resource
+def get_spreadsheet() -> gspread.Spreadsheet:
+    """
+    Opens the Google Sheets spreadsheet where the data is saved, only once for all the sessions.
+
+    :return: The spreadsheet.
+    """
+    return get_gspread_client().open_by_url(st.secrets["private_gsheets_url"])
+
+
+# The minimum seconds between reloads of the worksheets, when a worksheet isn't found
+WORKSHEETS_RELOAD_INTERVAL = 60
+
+
+@st.cache_resource
+def get_worksheets() -> Tuple[Dict[str, gspread.Worksheet], float]:
+    """
+    Gets all the worksheets of the spreadsheet where the data is saved with a single request, only once.
+
+    :return: A tuple with the dictionary of the worksheets by name and the time when they were loaded.
+    """
+    return {worksheet.title: worksheet for worksheet in get_spreadsheet().worksheets()}, time.time()
+
+
+def get_worksheet(sheet_name: str) -> gspread.Worksheet:
+    """
+    Gets a worksheet of the spreadsheet where the data is saved.
+
+    :param sheet_name: The name of the worksheet.
+    :return: The worksheet.
+    """
+    worksheets, loaded_at = get_worksheets()
+    if sheet_name not in worksheets and time.time() - loaded_at > WORKSHEETS_RELOAD_INTERVAL:
+        # The worksheet may have been created after the worksheets were loaded, so we load them again, but not more
+        # often than WORKSHEETS_RELOAD_INTERVAL so a missing worksheet doesn't send a request on every save
+        get_worksheets.clear()
+        worksheets, _ = get_worksheets()
+    if sheet_name not in worksheets:
+        raise gspread.WorksheetNotFound(sheet_name)
+    return worksheets[sheet_name]
+
+
+def spreadsheet_cell(value) -> Dict:
+    """
+    Converts a value to the cell data of the Google Sheets API, keeping its type.
 
-def spreadsheet_save_data(data: List, sheet_name: str = "Results") -> bool:
+    :param value: The value of the cell.
+    :return: The cell data, with the value as it is (not parsed as a formula).
     """
-    Saves data (the prompt and the generated story) to a Google Sheets worksheet.
+    if value is None:
+        return {}
+    if isinstance(value, bool):
+        return {'userEnteredValue': {'boolValue': value}}
+    if isinstance(value, (int, float)):
+        return {'userEnteredValue': {'numberValue': value}}
+    return {'userEnteredValue': {'stringValue': str(value)}}
 
-    This method appends a new row to the specified Google Sheets worksheet with the provided data list.
+
+def append_spreadsheet_rows(rows_by_sheet: Dict[str, List[List]]) -> None:
+    """
+    Appends rows to Google Sheets worksheets in a single request.
+
+    :param rows_by_sheet: The lists of data to append as new rows to each worksheet, by the name of the worksheet.
+    :return: None
+    """
+    append_requests = [{
+        'appendCells': {
+            'sheetId': get_worksheet(sheet_name).id,
+            'rows': [{'values': [spreadsheet_cell(value) for value in row]} for row in rows],
+            'fields': 'userEnteredValue',
+        }
+    } for sheet_name, rows in rows_by_sheet.items()]
+    get_spreadsheet().batch_update({'requests': append_requests})
+
+
+def spreadsheet_save_data(rows_by_sheet: Dict[str, List[List]]) -> Dict[str, List[List]]:
+    """
+    Saves data (the prompt and the generated story, and the feedback) to the Google Sheets worksheets.
+
+    This method appends the rows to all the specified Google Sheets worksheets in a single request.
+    If that request fails, each worksheet is saved with its own request, so a worksheet that can't be written doesn't
+    lose the rows of the others.
     It requires that we have valid credentials for accessing the Google Sheets API.
 
-    :param data: The list of data to append as a new row to the worksheet.
-    This list should contain the prompt and the generated story.
-    :param sheet_name: The name of the worksheet where the data will be appended.
-    If not provided, the default worksheet name is "Results".
-    :return: True if the operation was successful, False otherwise.
+    :param rows_by_sheet: The lists of data to append as new rows to each worksheet, by the name of the worksheet.
+    The rows for the "Results" worksheet contain the prompt and the generated story, and the rows for the
+    "Feedback" worksheet contain the feedback.
+    :return: The rows that couldn't be saved, by the name of the worksheet. Empty if all the rows were saved.
     """
+    unsaved = {}
+    existing = {}
+    for sheet_name, rows in rows_by_sheet.items():
+        try:
+            get_worksheet(sheet_name)
+            existing[sheet_name] = rows
+        except Exception as e:
+            print(f"Error while saving data to worksheet {sheet_name}: {e!r}")
+            unsaved[sheet_name] = rows
+    if not existing:
+        return unsaved
     try:
-        sh = client.open_by_url(st.secrets["private_gsheets_url"])
-        worksheet = sh.worksheet(sheet_name)
-        worksheet.append_row(data)
-        return True
+        append_spreadsheet_rows(existing)
     except Exception as e:
         print(f"Error while saving data to spreadsheet: {e}")
-        return False
+        if len(existing) == 1:
+            unsaved.update(existing)
+            return unsaved
+        for sheet_name, rows in existing.items():
+            try:
+                append_spreadsheet_rows({sheet_name: rows})
+            except Exception as e:
+                print(f"Error while saving data to worksheet {sheet_name}: {e!r}")
+                unsaved[sheet_name] = rows
+    return unsaved
+
+
+# The number of new queued rows that triggers saving them to the spreadsheet
+SPREADSHEET_FLUSH_ROWS = 5
+# The number of times rows are tried to be saved before they are dropped
+SPREADSHEET_MAX_ATTEMPTS = 3
+# The seconds to wait before trying to save rows again, doubled after each failed attempt
+SPREADSHEET_RETRY_DELAY = 60
+
+
+@st.cache_resource
+def get_pending_rows() -> Tuple[Dict[str, List[List]], List[Tuple[Dict[str, List[List]], int, float]], threading.Lock]:
+    """
+    Creates the queue of the rows to save to each worksheet, shared by all the sessions.
+
+    The rows that couldn't be saved are kept apart, with the number of attempts made and the time when they can be tried
+    again. The queued rows are also saved when the app shuts down.
+
+    :return: A tuple with the dictionary of the new rows queued for each worksheet, the list of the failed rows with
+    their attempts and retry time, and the lock that protects them.
+    """
+    atexit.register(save_pending_rows)
+    return {}, [], threading.Lock()
+
+
+def take_pending_rows(min_rows: int = 0, all_failed: bool = False) -> List[Tuple[Dict[str, List[List]], int]]:
+    """
+    Takes the new rows out of the queue, if there are at least `min_rows` of them, along with the failed rows that can
+    be tried again.
+
+    The failed rows are only taken with the new rows, so they never trigger saving by themselves.
+
+    :param min_rows: The minimum number of new queued rows to take them.
+    :param all_failed: If the failed rows should be taken even if they can't be tried again yet.
+    :return: The list of the batches of rows taken, with the number of attempts made for each one.
+    """
+    pending_rows, failed_rows, lock = get_pending_rows()
+    now = time.time()
+    with lock:
+        if sum(len(rows) for rows in pending_rows.values()) < min_rows:
+            return []
+        taken = [(dict(pending_rows), 0)] if pending_rows else []
+        pending_rows.clear()
+        waiting = []
+        for rows_by_sheet, attempts, retry_at in failed_rows:
+            if all_failed or retry_at <= now:
+                taken.append((rows_by_sheet, attempts))
+            else:
+                waiting.append((rows_by_sheet, attempts, retry_at))
+        failed_rows[:] = waiting
+    return taken
+
+
+def save_rows(rows_by_sheet: Dict[str, List[List]], attempts: int = 0) -> None:
+    """
+    Saves rows taken out of the queue. The rows that couldn't be saved are queued to be tried again later, until they
+    have been tried `SPREADSHEET_MAX_ATTEMPTS` times, when they are dropped and logged.
+
+    :param rows_by_sheet: The rows for each worksheet, by the name of the worksheet.
+    :param attempts: The number of times the rows were already tried to be saved.
+    :return: None
+    """
+    unsaved = spreadsheet_save_data(rows_by_sheet)
+    if not unsaved:
+        return
+    attempts += 1
+    if attempts >= SPREADSHEET_MAX_ATTEMPTS:
+        print(f"Dropping the rows that couldn't be saved after {attempts} attempts: {unsaved!r}")
+        return
+    _, failed_rows, lock = get_pending_rows()
+    with lock:
+        failed_rows.append((unsaved, attempts, time.time() + SPREADSHEET_RETRY_DELAY * 2 ** (attempts - 1)))
+
+
+def save_pending_rows() -> None:
+    """
+    Saves all the queued rows right away, including the failed ones.
+
+    :return: None
+    """
+    for rows_by_sheet, attempts in take_pending_rows(all_failed=True):
+        save_rows(rows_by_sheet, attempts)
+
+
+def queue_spreadsheet_row(data: List, sheet_name: str = "Results") -> None:
+    """
+    Queues a row to be saved to a Google Sheets worksheet when `flush_spreadsheet_rows` is called.
+
+    :param data: The list of data to append as a new row to the worksheet.
+    :param sheet_name: The name of the worksheet where the data will be appended.
+    If not provided, the default worksheet name is "Results".
+    :return: None
+    """
+    pending_rows, _, lock = get_pending_rows()
+    with lock:
+        pending_rows.setdefault(sheet_name, []).append(data)
+
+
+def flush_spreadsheet_rows(force: bool = False) -> None:
+    """
+    Saves the queued rows in the background, with a single request for all the worksheets, once there are enough of
+    them.
+
+    :param force: If the rows should be saved even if there are fewer than `SPREADSHEET_FLUSH_ROWS`.
+    :return: None
+    """
+    for rows_by_sheet, attempts in take_pending_rows(0 if force else SPREADSHEET_FLUSH_ROWS):
+        run_in_background(save_rows, rows_by_sheet, attempts)
 
 
 # Configuring the page
 st.set_page_config(page_title=variables.page_title, page_icon="📚", menu_items=variables.menu_items)
 
 # Setting up the sidebar
-st.sidebar.header('How to use')
-st.sidebar.markdown(variables.sidebar_how_to_use)
-st.sidebar.divider()
-
-st.sidebar.header('FAQ')
-for element in variables.faq:
-    for type_text, text in element.items():
-        if type_text == 'question':
-            st.sidebar.subheader(text)
-        elif type_text == 'answer':
-            st.sidebar.write(text)
+st.sidebar.markdown(variables.sidebar_markdown)
 
 st.sidebar.image('img/bmc_qr.png', width=200)
 
-# Main section
-st.title('Story Sprout')
-st.subheader('Create respectful stories for children up to 8 years old')
+# Main section, with the style removing the borders created by the styling of the forms, sent as a single element
+header = r'''
+<style>
+    [data-testid="stForm"] {
+        border: 0px;
+        padding: 0px;
+    }
+</style>
 
-# Removing the borders created by the styling of the forms
-css = r'''
-    <style>
-        [data-testid="stForm"] {
-            border: 0px;
-            padding: 0px;
-        }
-    </style>
+# Story Sprout
+### Create respectful stories for children up to 8 years old
 '''
-st.markdown(css, unsafe_allow_html=True)
+st.markdown(header, unsafe_allow_html=True)
+
+@st.cache_resource
+def get_settings() -> Dict:
+    """
+    Reads the settings of the app from the secrets, only once instead of on every rerun.
+
+    :return: A dictionary with the instructions we use for A/B testing, the test flags, and if the data is saved to
+    the spreadsheet and sent by email.
+    """
+    stories_secrets = st.secrets.stories
+    return {
+        'instructions': {instruction_name: stories_secrets[instruction_name] for instruction_name in
+                         stories_secrets.instructions},
+        'test_moderation': bool(stories_secrets.test_moderation),
+        'test_moderation_flagged': bool(stories_secrets.test_moderation_flagged),
+        'test_story': bool(stories_secrets.test_story),
+        'test_wait_time': stories_secrets.test_wait_time,
+        'test_reason': stories_secrets.test_reason,
+        'write_sheets': st.secrets.write_sheets,
+        'send_email': st.secrets.smtp.SEND_EMAIL,
+    }
+
+
+# Selecting the instructions we will use for A/B testing, and the other settings of the app
+SETTINGS = get_settings()
+INSTRUCTIONS = SETTINGS['instructions']
+TEST_MODERATION = SETTINGS['test_moderation']
+TEST_MODERATION_FLAGGED = SETTINGS['test_moderation_flagged']
+TEST_STORY = SETTINGS['test_story']
+TEST_WAIT_TIME = SETTINGS['test_wait_time']
+TEST_REASON = SETTINGS['test_reason']
+WRITE_SHEETS = SETTINGS['write_sheets']
+SEND_EMAIL = SETTINGS['send_email']
+
+
+@st.cache_resource
+def get_background_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Creates the pool of threads used to save data and send emails without blocking the page.
+
+    :return: The thread pool executor.
+    """
+    return concurrent.futures.ThreadPoolExecutor(max_workers=2)
 
-# Selecting the instructions we will use for A/B testing
-INSTRUCTIONS = {instruction_name: st.secrets.stories[instruction_name] for instruction_name in
-                st.secrets.stories.instructions}
-# Initializing the connection to OpenAI
-connect_openai = ConnectOpenAI.ConnectOpenAI(api_key=st.secrets['OPENAI_KEY'])
 
+@st.cache_resource
+def get_moderation_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Creates the pool of threads used to moderate prompts while their stories are being generated.
+
+    It is separate from the background executor, so a slow email or save never delays a story.
 
-def format_email_text(**kwargs) -> List:
+    :return: The thread pool executor.
+    """
+    return concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+
+def report_background_error(future: concurrent.futures.Future) -> None:
+    """
+    Reports the error of a background task as soon as it finishes.
+
+    :param future: The future of the finished background task.
+    :return: None
+    """
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Error in background task: {future.exception()}")
+
+
+def run_in_background(fn, *args, **kwargs) -> None:
+    """
+    Runs a function in a background thread, reporting its errors when it finishes.
+
+    :param fn: The function to run.
+    :param args: The positional arguments for the function.
+    :param kwargs: The keyword arguments for the function.
+    :return: None
+    """
+    future = get_background_executor().submit(fn, *args, **kwargs)
+    future.add_done_callback(report_background_error)
+
+
+@st.cache_resource
+def get_openai(api_key: str) -> ConnectOpenAI.ConnectOpenAI:
+    """
+    Initializes the connection to OpenAI, only once for all the sessions and reruns.
+
+    The connection is cached by its API key, so a new one is created if the key changes in the secrets.
+
+    :param api_key: The key for OpenAI's API.
+    :return: The connection to OpenAI.
+    """
+    return ConnectOpenAI.ConnectOpenAI(api_key=api_key)
+
+
+connect_openai = get_openai(st.secrets['OPENAI_KEY'])
+
+# The number of seconds a generated story is reused for the same prompt
+STORY_CACHE_TTL = 86400
+# The maximum number of stories kept to be reused
+STORY_CACHE_MAX_SIZE = 500
+
+
+@st.cache_resource
+def get_story_cache() -> Tuple[Dict, threading.Lock]:
+    """
+    Creates the cache of the stories generated for each prompt, shared by all the sessions.
+
+    :return: A tuple with the dictionary with the story, the finish reason and the time it was generated for each
+             prompt, and the lock that protects it.
+    """
+    return {}, threading.Lock()
+
+
+def get_cached_story(cache_key: Tuple) -> Optional[Tuple[str, str]]:
+    """
+    Gets the story already generated for a prompt, if it hasn't expired.
+
+    :param cache_key: The prompt, the age, the instruction key, the model and the version of the cache.
+    :return: A tuple with the story and the finish reason, or None if there is no story for the prompt.
+    """
+    story_cache, lock = get_story_cache()
+    with lock:
+        cached = story_cache.get(cache_key)
+    if cached is None or time.time() - cached[2] > STORY_CACHE_TTL:
+        return None
+    return cached[0], cached[1]
+
+
+def cache_story(cache_key: Tuple, story: str, finish_reason: str) -> None:
+    """
+    Saves a generated story in the cache, removing the stories that expired and the oldest ones if it is full.
+
+    :param cache_key: The prompt, the age, the instruction key, the model and the version of the cache.
+    :param story: The generated story.
+    :param finish_reason: The reason the story generation was completed.
+    :return: None
+    """
+    story_cache, lock = get_story_cache()
+    now = time.time()
+    with lock:
+        for key in [key for key, cached in story_cache.items() if now - cached[2] > STORY_CACHE_TTL]:
+            del story_cache[key]
+        story_cache.pop(cache_key, None)
+        # The dictionary keeps the insertion order, so the first stories are the oldest ones
+        while len(story_cache) >= STORY_CACHE_MAX_SIZE:
+            del story_cache[next(iter(story_cache))]
+        story_cache[cache_key] = (story, finish_reason, now)
+
+
+def format_email_html(**kwargs) -> str:
     """
     Formats a message for an email
 
     :param kwargs: The parameters to include in the email
-    :return: lines in HTML format for the email
+    :return: The message in HTML format for the email
     """
-    lines = []
-    for key, val in kwargs.items():
-        lines.append(f"<strong>{key}</strong>")
-        lines.append(str(val))
-        lines.append('')
-    return lines
+    return ''.join(f"<strong>{key}</strong><br />\n{val}<br />\n<br />\n" for key, val in kwargs.items())
 
 
-def send_email(message: list, feedback: bool = False) -> None:
+@st.cache_resource
+def get_email_addresses() -> Tuple[str, str, str]:
     """
-    Sends an email message
+    Builds the addresses of the sender and the receiver of the emails, only once and only when an email is sent.
 
-    :param message: The lines of the message
-    :param feedback: If the message to send is about a feedback received instead of a new created story
-    :return: None
+    :return: A tuple with the email of the sender, and the sender and the receiver with their names.
     """
-    sender_name = st.secrets.smtp.SENDER_NAME
-    sender_email = st.secrets.smtp.SENDER_EMAIL
-    sender_email_complete = f"{sender_name} <{sender_email}>"
-    receiver_name = st.secrets.smtp.RECIPIENT_NAME
-    receiver_email = f"{receiver_name} <{st.secrets.smtp.RECIPIENT_EMAIL}>"
-    password = st.secrets.smtp.SENDER_PASSWORD
-    today = datetime.datetime.today()
-    title = 'feedback received' if feedback else 'story created'
-    subject = f"[Story Sprout] - New {title}, {today.strftime('%F %T')}"
-    message = '<br />\n'.join(message)
+    smtp_secrets = st.secrets.smtp
+    return (smtp_secrets.SENDER_EMAIL,
+            f"{smtp_secrets.SENDER_NAME} <{smtp_secrets.SENDER_EMAIL}>",
+            f"{smtp_secrets.RECIPIENT_NAME} <{smtp_secrets.RECIPIENT_EMAIL}>")
 
-    msg = MIMEMultipart()
-    msg['From'] = sender_email_complete
-    msg['To'] = receiver_email
-    msg['Subject'] = subject
 
-    body = f"""
+# The body of the emails, the same for all of them
+EMAIL_BODY = string.Template("""
         <html>
         <body>
-        {message}
+        $html
         </body>
         </html>
-        """
+        """)
+
+
+@st.cache_resource
+def get_smtp_connection() -> smtplib.SMTP_SSL:
+    """
+    Opens an authenticated connection to the SMTP server, which is kept alive and reused to send all the emails.
+
+    The connection uses TLS from the start, which saves the round trips of STARTTLS, and times out so a server that
+    doesn't answer can't block the background threads forever.
+
+    :return: The connection to the SMTP server.
+    """
+    server = smtplib.SMTP_SSL('smtp.gmail.com', 465, timeout=10)
+    server.login(st.secrets.smtp.SENDER_EMAIL, st.secrets.smtp.SENDER_PASSWORD)
+    return server
+
+
+@st.cache_resource
+def get_smtp_lock() -> threading.Lock:
+    """
+    Creates the lock that prevents two threads from sending an email over the SMTP connection at the same time.
+
+    :return: The lock.
+    """
+    return threading.Lock()
+
+
+def send_email(html: str, feedback: bool = False) -> None:
+    """
+    Sends an email message
+
+    :param html: The message, already in HTML format
+    :param feedback: If the message to send is about a feedback received instead of a new created story
+    :return: None
+    """
+    today = datetime.datetime.now().isoformat(sep=' ', timespec='seconds')
+    title = 'feedback received' if feedback else 'story created'
 
-    msg.attach(MIMEText(body, 'html'))
+    sender_email, email_sender, email_receiver = get_email_addresses()
+    msg = MIMEText(EMAIL_BODY.substitute(html=html), 'html')
+    msg['From'] = email_sender
+    msg['To'] = email_receiver
+    msg['Subject'] = f"[Story Sprout] - New {title}, {today}"
 
-    with smtplib.SMTP('smtp.gmail.com', 587) as server:
-        server.starttls()
-        server.login(sender_email, password)
-        server.sendmail(sender_email, receiver_email, msg.as_string())
+    with get_smtp_lock():
+        try:
+            get_smtp_connection().sendmail(sender_email, email_receiver, msg.as_string())
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException, ConnectionError, TimeoutError) as e:
+            if isinstance(e, smtplib.SMTPResponseException) and not isinstance(e, smtplib.SMTPSenderRefused) \
+                    and not 400 <= e.smtp_code < 500:
+                raise
+            # The server closed or timed out the connection since the last email, so we connect again and retry once
+            get_smtp_connection.clear()
+            get_smtp_connection().sendmail(sender_email, email_receiver, msg.as_string())
+
+
+# Compiled once, so checking a prompt locally is much cheaper than a call to OpenAI's moderation tool
+BLOCKED_WORDS = re.compile(r'\b(' + '|'.join(re.escape(word) for word in variables.prompt_blocked_words) + r')\b',
+                           re.IGNORECASE)
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def moderate_prompt(user_message: str, test: bool, test_flagged: bool) -> bool:
+    """
+    Moderates a prompt with OpenAI's moderation tool, reusing the result for the same prompt.
+
+    :param user_message: The message provided by the user.
+    :param test: If the moderation is run in test mode.
+    :param test_flagged: The moderation result when in test mode.
+    :return: True if the prompt was flagged, False otherwise.
+    """
+    return connect_openai.moderate_message(user_message, test=test, test_flagged=test_flagged)
+
+
+def needs_moderation(user_message: str) -> bool:
+    """
+    Checks a prompt locally, to avoid calling OpenAI's moderation tool when the prompt is obviously safe.
+
+    :param user_message: The message provided by the user.
+    :return: False if the prompt is short and has no blocked words, True if the prompt needs to be moderated by
+             OpenAI's moderation tool.
+    """
+    return bool(BLOCKED_WORDS.search(user_message)) or len(user_message) >= variables.prompt_moderation_min_length
 
 
 def prompt_section() -> None:
@@ -148,7 +553,7 @@ def prompt_section() -> None:
     The user can input details for creating a story.
     It includes a text area for story details and a number input for the age of the reader.
     When the form is submitted, it checks if the input is valid by moderating it through the OpenAI's moderation
-    tool.
+    tool. The moderation runs in the background, and its result is checked by `generate_story`.
 
     :return: None
     """
@@ -168,36 +573,83 @@ def prompt_section() -> None:
                     prompt_error = variables.prompt_no_text_error
                 # If we have a prompt, moderate it
                 else:
-                    # If the prompt is flagged, we show an error message
-                    test = bool(st.secrets.stories.test_moderation)
-                    flagged = bool(st.secrets.stories.test_moderation_flagged)
-                    if connect_openai.moderate_message(st.session_state.user_message, test=test, test_flagged=flagged):
-                        prompt_error = variables.prompt_flagged_error
-                    else:
-                        prompt_error = False
+                    prompt_error = False
+                    # The moderation runs while the story starts being generated, which checks its result and shows
+                    # an error message if the prompt is flagged
+                    if TEST_MODERATION or needs_moderation(st.session_state.user_message):
+                        st.session_state.moderation = get_moderation_executor().submit(
+                            moderate_prompt, st.session_state.user_message,
+                            test=TEST_MODERATION, test_flagged=TEST_MODERATION_FLAGGED)
                 st.session_state.prompt_error = prompt_error
 
 
-def generate_story() -> None:
+def hold_until_moderated(stream: Iterator[str], moderation: Optional[concurrent.futures.Future]) -> Iterator[str]:
+    """
+    Yields the pieces of a story only once its prompt passed the moderation, stopping the story if it was flagged.
+
+    :param stream: The pieces of the story being generated.
+    :param moderation: The future of the moderation of the prompt, or None if the prompt doesn't need it.
+    :return: An iterator over the pieces of the story.
+    """
+    for piece in stream:
+        if moderation is not None:
+            if moderation.result():
+                stream.close()
+                return
+            moderation = None
+        yield piece
+
+
+def generate_story() -> bool:
     """
     This method generates a story based on the user's input and writes it to the session state.
 
-    The function first constructs the user's message and then uses the connect_openai.create_story method to generate
-    a story based on that message and a randomly chosen instruction.
+    The function first constructs the user's message and then uses the connect_openai.create_story_stream method to
+    generate a story based on that message and an instruction randomly chosen for the session.
+    The story is requested while the user's input is still being moderated, so the moderation doesn't delay it. If the
+    input is flagged, the story is discarded before showing any of it.
+    If a story was already generated for the same message and instruction, it is reused instead of calling OpenAI.
 
     The function then gathers relevant data, stores it in a dictionary, and appends this to a list in the session state.
     Finally, it checks if it should save the data to a spreadsheet or send it in an email, and if so, does so.
 
-    :return: None
+    :return: True if the story was generated, False if the user's input was flagged by the moderation.
     """
     user_message = f'{st.session_state.user_message}.\n\nMake the story for a {st.session_state.age} year old.'
-    test = bool(st.secrets.stories.test_story)
-    wait_time = st.secrets.stories.test_wait_time
-    reason = st.secrets.stories.test_reason
-    instruction_key = random.choice(list(INSTRUCTIONS.keys()))
+    # The instruction is drawn once per session, so its stories reuse the prompt prefix cached by OpenAI
+    if 'instruction_key' not in st.session_state:
+        st.session_state.instruction_key = random.choice(list(INSTRUCTIONS.keys()))
+    instruction_key = st.session_state.instruction_key
     instruction = INSTRUCTIONS[instruction_key]
-    story_text, finish_reason = connect_openai.create_story(user_message=user_message, instruction=instruction,
-                                                            test=test, test_reason=reason, wait_time=wait_time)
+    moderation = st.session_state.moderation
+    st.session_state.moderation = None
+    # The same prompt with the same instruction gets the story that was already generated for it
+    cache_key = (st.session_state.user_message, st.session_state.age, instruction_key, connect_openai.model,
+                 variables.story_cache_version)
+    cached_story = None if TEST_STORY else get_cached_story(cache_key)
+    if cached_story is not None:
+        if moderation is not None and moderation.result():
+            st.session_state.prompt_error = variables.prompt_flagged_error
+            return False
+        story_text, finish_reason = cached_story
+        estimated_tokens = total_tokens = 0
+    else:
+        # Showing the story while it is being generated, it is moved to its own expander once it is complete
+        placeholder = st.empty()
+        stream = connect_openai.create_story_stream(user_message=user_message, instruction=instruction,
+                                                    test=TEST_STORY, test_reason=TEST_REASON,
+                                                    wait_time=TEST_WAIT_TIME)
+        story_text = placeholder.write_stream(hold_until_moderated(stream, moderation)) or ''
+        placeholder.empty()
+        if moderation is not None and moderation.result():
+            st.session_state.prompt_error = variables.prompt_flagged_error
+            return False
+        finish_reason = connect_openai.finish_reason
+        estimated_tokens = connect_openai.estimated_tokens
+        total_tokens = connect_openai.total_tokens
+        # Only complete stories are reused, a story that was cut off or filtered is generated again the next time
+        if not TEST_STORY and finish_reason == 'stop':
+            cache_story(cache_key, story_text, finish_reason)
     story_warning_text = None
     if finish_reason == 'length':
         story_warning_text = 'The response was cut off because it was too long.'
@@ -214,16 +666,17 @@ def generate_story() -> None:
         'instruction': instruction,
         'story': story_text,
         'finish_reason': finish_reason,
-        'estimated_tokens': connect_openai.estimated_tokens,
-        'total_tokens': connect_openai.total_tokens,
+        'estimated_tokens': estimated_tokens,
+        'total_tokens': total_tokens,
         'count': len(st.session_state.stories_data),
+        'story_id': uuid.uuid4().hex,
     }
     st.session_state.stories_data.append(data)
-    if st.secrets.write_sheets:
-        spreadsheet_save_data(list(data.values()))
-    if st.secrets.smtp.SEND_EMAIL:
-        lines = format_email_text(**data)
-        send_email(lines)
+    if WRITE_SHEETS:
+        queue_spreadsheet_row(list(data.values()))
+    if SEND_EMAIL:
+        run_in_background(send_email, format_email_html(**data))
+    return True
 
 
 def create_story_feedback_section(data: Dict) -> None:
@@ -232,7 +685,7 @@ def create_story_feedback_section(data: Dict) -> None:
 
     The feedback includes a numerical rating and optional additional comments.
     Once the user submits the feedback, the function updates the session state with this feedback and,
-    if configured to do so, writes the feedback data to a spreadsheet and sends an email with the data.
+    if configured to do so, writes the feedback to a spreadsheet and sends an email with all the data of the story.
 
     :param data: A dictionary containing the data of the story for which feedback is being collected.
     :return: None
@@ -251,11 +704,13 @@ def create_story_feedback_section(data: Dict) -> None:
                 'feedback': st.session_state.feedback,
                 'additional_comments': st.session_state.additional_comments,
             })
-            if st.secrets.write_sheets:
-                spreadsheet_save_data(list(data.values()), 'Feedback')
-            if st.secrets.smtp.SEND_EMAIL:
-                lines = format_email_text(**data)
-                send_email(lines, feedback=True)
+            if WRITE_SHEETS:
+                # Only the feedback is saved, the rest of the story is already in the "Results" worksheet
+                feedback_row = [data['story_id'], data['count'], st.session_state.feedback,
+                                st.session_state.additional_comments]
+                queue_spreadsheet_row(feedback_row, 'Feedback')
+            if SEND_EMAIL:
+                run_in_background(send_email, format_email_html(**data), feedback=True)
 
 
 def restart_app() -> None:
@@ -264,6 +719,7 @@ def restart_app() -> None:
 
     :return: None
     """
+    flush_spreadsheet_rows(force=True)
     for k in st.session_state.keys():
         del st.session_state[k]
 
@@ -274,6 +730,8 @@ if 'prompt_error' not in st.session_state:
     st.session_state.prompt_error = None
 if 'story_warning' not in st.session_state:
     st.session_state.story_warning = None
+if 'moderation' not in st.session_state:
+    st.session_state.moderation = None
 
 prompt_section()
 if st.session_state.prompt_error is not None:
@@ -283,11 +741,16 @@ if st.session_state.prompt_error is not None:
         st.divider()
         # If the prompt form was submitted, generate a story
         if st.session_state['FormSubmitter:prompt-Generate story']:
-            with st.spinner('Creating your story can take some seconds, please be patient...'):
-                generate_story()
-                if st.session_state.story_warning:
-                    st.warning(st.session_state.story_warning)
-                st.success("Here's your story!")
+            status = st.empty()
+            status.info('Creating your story can take some seconds, please be patient...')
+            generated = generate_story()
+            status.empty()
+            if not generated:
+                st.error(st.session_state.prompt_error)
+                st.stop()
+            if st.session_state.story_warning:
+                st.warning(st.session_state.story_warning)
+            st.success("Here's your story!")
         # Display all the stories that have been shared so far
         for num in range(len(st.session_state.stories_data), 0, -1):
             expanded = True if (num == len(st.session_state.stories_data)) else False
@@ -295,3 +758,6 @@ if st.session_state.prompt_error is not None:
                 create_story_feedback_section(st.session_state.stories_data[num - 1])
         # Provide an option to clean all stories and start again
         st.button("Clean stories and start again?", on_click=restart_app)
+
+# Saving the queued rows at once when there are enough of them
+flush_spreadsheet_rows()
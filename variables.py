@@ -1,3 +1,5 @@
+import textwrap
+
 # Page config variables
 page_title = 'Story Sprout: Engaging, Culturally Diverse, & Emotionally Intelligent Short Stories for Children'
 menu_items = {
@@ -54,10 +56,10 @@ faq = (
     },
     {
         'question': "Will all the stories be different?",
-        'answer': "Yes, each story generated by Story Sprout is unique, thanks to the input you provide and the "
-                  "advanced AI that crafts the story. Even when using similar short statements or preferences, "
-                  "the AI is designed to create different narratives, ensuring a fresh and engaging experience "
-                  "each time.",
+        'answer': "Each story generated by Story Sprout is unique to the input you provide, thanks to the "
+                  "advanced AI that crafts the story. Different short statements or preferences, even similar "
+                  "ones, lead to different narratives. If you send exactly the same statement with the same "
+                  "preferences within a day, you will get the same story again; change a word to get a new one.",
     },
     {
         'question': "Can I share the stories that Story Sprout generates?",
@@ -104,6 +106,11 @@ faq = (
     },
 )
 
+# The whole text of the sidebar, built once when the app starts
+sidebar_markdown = '## How to use\n' + textwrap.dedent(sidebar_how_to_use).strip() + '\n\n---\n\n## FAQ\n\n' + \
+                   '\n\n'.join(f"### {element['question']}\n{textwrap.dedent(element['answer']).strip()}"
+                             for element in faq)
+
 # Main prompt variables
 prompt_text_area_help = 'Let us know what the story should be about, indicating the name of the child(ren) involved ' \
                         'and any other detail you think is relevant to the story'
@@ -120,7 +127,14 @@ openai_url = "https://openai.com/policies/usage-policies"
 prompt_flagged_error = "Your prompt does not comply with OpenAI's " \
                        f"usage policies: <{openai_url}> 🔗.\n\n" \
                        "Please try again."
-prompt_button_caption = 'Each time you click on "Generate story", a new story will be created. ' \
+# Words that always get a prompt sent to OpenAI's moderation tool, even if it is short
+prompt_blocked_words = (
+    'kill', 'killing', 'murder', 'suicide', 'blood', 'gun', 'guns', 'rape', 'sex', 'sexy', 'naked', 'nude', 'porn',
+    'drugs', 'cocaine', 'heroin', 'torture', 'terrorist',
+)
+# Prompts shorter than this and without blocked words are not sent to OpenAI's moderation tool
+prompt_moderation_min_length = 20
+prompt_button_caption = 'Each time you click on "Generate story" with a new prompt, a new story will be created. ' \
                         'All the stories will remain here until you refresh the page or restart the app.'
 
 # Rate section variables
@@ -145,6 +159,8 @@ rate_msg = "Thank you for using Story Sprout! We hope you enjoyed your unique st
            "improve and deliver even better stories."
 
 # Support variables
+# Changing the version discards all the stories kept to be reused for the same prompt
+story_cache_version = '1'
 example_story = """
 Once upon a time, in a small, cozy house, lived a child named Sam. Sam loved playing in their big, green backyard. 
 It was filled with tall trees, colorful flowers, and soft grass. Everyday after breakfast, Sam would run outside to 